@@ -1,18 +1,21 @@
 #! /usr/bin/env python3
 
 import os
+import hashlib  # CIRCUITPY-CHANGE
+import shutil  # CIRCUITPY-CHANGE
 import subprocess
 import sys
 import sysconfig
 import platform
 import argparse
+import collections  # CIRCUITPY-CHANGE
+import functools  # CIRCUITPY-CHANGE
 import inspect
 import json
 import re
-from glob import glob
+from fnmatch import fnmatch  # CIRCUITPY-CHANGE
+from glob import glob, escape as glob_escape  # CIRCUITPY-CHANGE
 import multiprocessing
-from multiprocessing.pool import ThreadPool
-import threading
 import tempfile
 
 # Maximum time to run a PC-based test, in seconds.
@@ -45,10 +48,25 @@ else:
     # mpy-cross is only needed if --via-mpy command-line arg is passed
     MPYCROSS = os.getenv("MICROPY_MPYCROSS", base_path("../mpy-cross/build/mpy-cross"))
 
+# CIRCUITPY-CHANGE: directory of helper modules available to tests.
+TESTLIB_DIR = base_path("testlib")
+
+# CIRCUITPY-CHANGE: absolute paths of the executables, for running from another directory.
+MICROPYTHON_ABS = os.path.abspath(MICROPYTHON)
+MPYCROSS_ABS = os.path.abspath(MPYCROSS)
+
 # Use CPython options to not save .pyc files, to only access the core standard library
 # (not site packages which may clash with u-module names), and improve start up time.
+# CIRCUITPY-CHANGE: don't use -O/-OO, tests rely on assert statements and docstrings.
 CPYTHON3_CMD = [CPYTHON3, "-BS"]
 
+# CIRCUITPY-CHANGE: directories to cache .mpy files and CPython's expected output between runs
+CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "micropython-tests"
+)
+MPY_CACHE_DIR = os.path.join(CACHE_DIR, "mpy")
+EXP_CACHE_DIR = os.path.join(CACHE_DIR, "exp")
+
 # File with the test results.
 RESULTS_FILE = "_results.json"
 
@@ -95,24 +113,191 @@ def rm_f(fname):
         os.remove(fname)
 
 
+# CIRCUITPY-CHANGE: in .exp files of special tests, backslash-escaped chars have their regex
+# meaning and all other regex metacharacters are literal.
+regex_escape_re = re.compile(rb"\\(.?)|([()\[\]{}.*+^$])", re.DOTALL)
+
+
+def convert_regex_escape(m):
+    return b"\\" + m.group(2) if m.group(1) is None else m.group(1)
+
+
 # unescape wanted regex chars and escape unwanted ones
 def convert_regex_escapes(line):
-    cs = []
-    escape = False
-    for c in str(line, "utf8"):
-        if escape:
-            escape = False
-            cs.append(c)
-        elif c == "\\":
-            escape = True
-        elif c in ("(", ")", "[", "]", "{", "}", ".", "*", "+", "^", "$"):
-            cs.append("\\" + c)
-        else:
-            cs.append(c)
+    line = regex_escape_re.sub(convert_regex_escape, line)  # CIRCUITPY-CHANGE
     # accept carriage-return(s) before final newline
-    if cs[-1] == "\n":
-        cs[-1] = "\r*\n"
-    return bytes("".join(cs), "utf8")
+    if line.endswith(b"\n"):
+        line = line[:-1] + b"\r*\n"
+    return line
+
+
+# CIRCUITPY-CHANGE: build one regex matching a special test's whole output against its .exp
+# lines, so a passing test needs one regex run.  None if the .exp file can't be expressed so.
+def compile_exp_whole(lines_exp):
+    pattern = []
+    for i, line in enumerate(lines_exp):
+        if len(line) == 1:
+            if i + 1 >= len(lines_exp) or len(lines_exp[i + 1]) == 1:
+                return None
+            pattern.append(b"(?:(?!" + lines_exp[i + 1][1].pattern + b").*\n)*")
+        else:
+            pattern.append(b"(?P<l%d>" % i + line[1].pattern + b")")
+    try:
+        return re.compile(b"".join(pattern))
+    except re.error:
+        # a line can be a valid regex on its own but not within others, eg with (?i)
+        return None
+
+
+# CIRCUITPY-CHANGE: read a special test's .exp file, which is needed twice, keeping a few.
+# The mtime argument is only there so the cache is invalidated if the file changes.
+@functools.lru_cache(maxsize=16)
+def read_exp_file(exp_filename, mtime):
+    with open(exp_filename, "rb") as f:
+        return f.read()
+
+
+# CIRCUITPY-CHANGE: load the lines of a special test's .exp file, the regex for each line (or
+# the line itself for ######## lines) and the whole-file regex from compile_exp_whole.
+@functools.lru_cache(maxsize=None)
+def load_exp_patterns(exp_filename, mtime):
+    lines_exp = []
+    for line in re.findall(rb"[^\n]*\n|[^\n]+$", read_exp_file(exp_filename, mtime)):
+        if line == b"########\n":
+            line = (line,)
+        else:
+            line = (line, re.compile(convert_regex_escapes(line)))
+        lines_exp.append(line)
+    lines_exp = tuple(lines_exp)
+    return lines_exp, compile_exp_whole(lines_exp)
+
+
+# CIRCUITPY-CHANGE: match a special test's output against the whole-file regex, True only if
+# each regex line matched exactly one line of output.
+def match_exp_whole(exp_whole, output):
+    m = exp_whole.fullmatch(output)
+    if m is None:
+        return False
+    for line in m.groupdict().values():
+        if b"\n" in line[:-1]:
+            return False
+    return True
+
+
+# CIRCUITPY-CHANGE
+def write_cache_file(cache_filename, data):
+    # Write to a temporary name then rename, so other runs never see a partial file.  The
+    # cache is only an optimisation, so errors writing to it are ignored.
+    cache_dir = os.path.dirname(cache_filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_filename, cache_filename)
+        finally:
+            rm_f(temp_filename)
+    except OSError:
+        pass
+
+
+# CIRCUITPY-CHANGE
+def mpy_cache_key(args, source_name, script_text):
+    # The key covers everything that affects the .mpy output: the mpy-cross binary itself,
+    # the options passed to it, the source name stored in the .mpy and the source code.
+    st = os.stat(MPYCROSS)
+    options = (MPYCROSS_ABS, st.st_mtime_ns, st.st_size)
+    options += (args.mpy_cross_flags, args.emit, source_name)
+    key = hashlib.sha1(bytes(repr(options), "utf-8"))
+    key.update(script_text)
+    return key.hexdigest()
+
+
+# CIRCUITPY-CHANGE: the state of all files in a directory tree, as seen by os.stat, so that
+# cached expected output is only reused while a test's directory and testlib haven't changed.
+# Compiled files are left out, as --via-mpy and CPython create and remove them during a run.
+def dir_tree_state(dir):
+    state = []
+    for dirpath, dirnames, filenames in os.walk(dir):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for filename in sorted(filenames):
+            if filename.endswith((".mpy", ".pyc")):
+                continue
+            st = os.stat(os.path.join(dirpath, filename))
+            state.append((dirpath, filename, st.st_mtime_ns, st.st_size))
+    return hashlib.sha1(bytes(repr(state), "utf-8")).hexdigest()
+
+
+# CIRCUITPY-CHANGE: the CPython executable that CPYTHON3_CMD runs, as seen by os.stat.
+@functools.lru_cache(maxsize=None)
+def cpython_state(path):
+    executable = shutil.which(CPYTHON3, path=path) or CPYTHON3
+    st = os.stat(executable)
+    return os.path.abspath(executable), st.st_mtime_ns, st.st_size
+
+
+# CIRCUITPY-CHANGE
+def exp_cache_key(test_file_abspath, env, dir_states):
+    # The key covers everything that affects CPython's output for a test: the CPython binary
+    # and its options, the environment it runs in, the test itself and the files around it,
+    # with dir_states mapping directories to their dir_tree_state() from before the run.
+    options = (CPYTHON3_CMD, cpython_state(env["PATH"]), sorted(env.items()), test_file_abspath)
+    options += (dir_states[os.path.dirname(test_file_abspath)], dir_states[TESTLIB_DIR])
+    key = hashlib.sha1(bytes(repr(options), "utf-8"))
+    with open(test_file_abspath, "rb") as f:
+        key.update(f.read())
+    return key.hexdigest()
+
+
+# CIRCUITPY-CHANGE
+def compile_to_mpy(args, *, script_filename=None, script_text=None):
+    # Compile a script with mpy-cross and return (had_crash, .mpy data), using MPY_CACHE_DIR
+    # unless --no-cache is given (run-perfbench.py's args don't have that option).
+    if script_filename is not None:
+        with open(script_filename, "rb") as f:
+            script_text = f.read()
+
+    cache_filename = None
+    if not getattr(args, "no_cache", False):
+        try:
+            cache_filename = os.path.join(
+                MPY_CACHE_DIR, mpy_cache_key(args, script_filename, script_text) + ".mpy"
+            )
+            with open(cache_filename, "rb") as f:
+                return False, f.read()
+        except OSError:
+            pass
+
+    cmdlist = [MPYCROSS] + args.mpy_cross_flags.split() + ["-X", "emit=" + args.emit]
+    if os.name == "nt":
+        # stdout is in text mode on Windows, which would mangle the .mpy data
+        fd, mpy_filename = tempfile.mkstemp(suffix=".mpy")
+        os.close(fd)
+        cmdlist += ["-o", mpy_filename]
+    else:
+        cmdlist += ["-o", "-"]
+    if script_filename is None:
+        cmdlist.append("-")
+    else:
+        cmdlist.append(script_filename)
+        script_text = None
+    result = subprocess.run(
+        cmdlist, input=script_text, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    mpy = result.stdout
+    if os.name == "nt":
+        if result.returncode == 0:
+            with open(mpy_filename, "rb") as f:
+                mpy = f.read()
+        rm_f(mpy_filename)
+    if result.returncode != 0:
+        return True, b"mpy-cross crash\n" + result.stdout + result.stderr
+
+    if cache_filename is not None:
+        write_cache_file(cache_filename, mpy)
+
+    return False, mpy
 
 
 def prepare_script_for_target(args, *, script_filename=None, script_text=None, force_plain=False):
@@ -121,34 +306,14 @@ def prepare_script_for_target(args, *, script_filename=None, script_text=None, f
             with open(script_filename, "rb") as f:
                 script_text = f.read()
     elif args.via_mpy:
-        tempname = tempfile.mktemp(dir="")
-        mpy_filename = tempname + ".mpy"
-
-        if script_filename is None:
-            script_filename = tempname + ".py"
-            cleanup_script_filename = True
-            with open(script_filename, "wb") as f:
-                f.write(script_text)
-        else:
-            cleanup_script_filename = False
-
-        try:
-            subprocess.check_output(
-                [MPYCROSS]
-                + args.mpy_cross_flags.split()
-                + ["-o", mpy_filename, "-X", "emit=" + args.emit, script_filename],
-                stderr=subprocess.STDOUT,
-            )
-        except subprocess.CalledProcessError as er:
-            return True, b"mpy-cross crash\n" + er.output
-
-        with open(mpy_filename, "rb") as f:
-            script_text = b"__buf=" + bytes(repr(f.read()), "ascii") + b"\n"
-
-        rm_f(mpy_filename)
-        if cleanup_script_filename:
-            rm_f(script_filename)
+        # CIRCUITPY-CHANGE: use compile_to_mpy, which caches the .mpy
+        had_crash, mpy = compile_to_mpy(
+            args, script_filename=script_filename, script_text=script_text
+        )
+        if had_crash:
+            return True, mpy
 
+        script_text = b"__buf=" + bytes(repr(mpy), "ascii") + b"\n"
         script_text += bytes(injected_import_hook_code, "ascii")
     else:
         print("error: using emit={} must go via .mpy".format(args.emit))
@@ -177,7 +342,7 @@ def run_script_on_remote_target(pyb, args, test_file, is_special):
     return had_crash, output_mupy
 
 
-special_tests = [
+special_tests = frozenset(  # CIRCUITPY-CHANGE
     base_path(file)
     for file in (
         "micropython/meminfo.py",
@@ -188,17 +353,18 @@ special_tests = [
         "circuitpython/traceback_test.py",  # CIRCUITPY-CHANGE
         "circuitpython/traceback_test_chained.py",  # CIRCUITPY-CHANGE
     )
-]
+)
+
+# CIRCUITPY-CHANGE: all tests in these directories are special tests
+special_test_dirs = (base_path("cmdline/"), base_path("feature_check/"))
 
 
 def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
     had_crash = False
     if pyb is None:
         # run on PC
-        if (
-            test_file_abspath.startswith((base_path("cmdline/"), base_path("feature_check/")))
-            or test_file_abspath in special_tests
-        ):
+        # CIRCUITPY-CHANGE: special_test_dirs
+        if test_file_abspath.startswith(special_test_dirs) or test_file_abspath in special_tests:
             # special handling for tests of the unix cmdline program
             is_special = True
 
@@ -231,7 +397,10 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
                         while True:
                             ready = select.select([master], [], [], 0.02)
                             if ready[0] == [master]:
-                                rv += os.read(master, 1024)
+                                rv += os.read(master, 65536)  # CIRCUITPY-CHANGE
+                                # CIRCUITPY-CHANGE: drain whatever else is already available
+                                while select.select([master], [], [], 0)[0]:
+                                    rv += os.read(master, 65536)
                             else:
                                 if not required or rv:
                                     return rv
@@ -262,8 +431,10 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
                         os.close(master)
                         os.close(slave)
                 else:
+                    # CIRCUITPY-CHANGE: close_fds=False lets subprocess use posix_spawn;
+                    # Python's own fds are non-inheritable anyway.
                     output_mupy = subprocess.check_output(
-                        args + [test_file], stderr=subprocess.STDOUT
+                        args + [test_file], stderr=subprocess.STDOUT, close_fds=False
                     )
             except subprocess.CalledProcessError:
                 return b"CRASH"
@@ -272,7 +443,7 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
             # a standard test run on PC
 
             # create system command
-            cmdlist = [os.path.abspath(MICROPYTHON), "-X", "emit=" + args.emit]
+            cmdlist = [MICROPYTHON_ABS, "-X", "emit=" + args.emit]  # CIRCUITPY-CHANGE
             if args.heapsize is not None:
                 cmdlist.extend(["-X", "heapsize=" + args.heapsize])
             if sys.platform == "darwin":
@@ -283,27 +454,35 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
             # if running via .mpy, first compile the .py file
             if args.via_mpy:
                 mpy_filename = tempfile.mktemp(dir=cwd, suffix=".mpy")
-                subprocess.check_output(
-                    [MPYCROSS]
-                    + args.mpy_cross_flags.split()
-                    + ["-o", mpy_filename, "-X", "emit=" + args.emit, test_file]
-                )
+                # CIRCUITPY-CHANGE: use compile_to_mpy, which caches the .mpy
+                had_crash, mpy = compile_to_mpy(args, script_filename=test_file)
+                if had_crash:
+                    output_mupy = mpy
+                else:
+                    with open(mpy_filename, "wb") as f:
+                        f.write(mpy)
                 mpy_modname = os.path.splitext(os.path.basename(mpy_filename))[0]
                 cmdlist.extend(["-m", mpy_modname])
             else:
                 cmdlist.append(test_file_abspath)
 
-            # run the actual test
-            try:
-                output_mupy = subprocess.check_output(
-                    cmdlist, stderr=subprocess.STDOUT, timeout=TEST_TIMEOUT, cwd=cwd
-                )
-            except subprocess.CalledProcessError as er:
-                had_crash = True
-                output_mupy = er.output + b"CRASH"
-            except subprocess.TimeoutExpired as er:
-                had_crash = True
-                output_mupy = (er.output or b"") + b"TIMEOUT"
+            # CIRCUITPY-CHANGE: run the actual test, unless compiling it to .mpy failed
+            if not had_crash:
+                try:
+                    # close_fds=False saves closing every open fd in the child, see above
+                    output_mupy = subprocess.check_output(
+                        cmdlist,
+                        stderr=subprocess.STDOUT,
+                        timeout=TEST_TIMEOUT,
+                        cwd=cwd,
+                        close_fds=False,
+                    )
+                except subprocess.CalledProcessError as er:
+                    had_crash = True
+                    output_mupy = er.output + b"CRASH"
+                except subprocess.TimeoutExpired as er:
+                    had_crash = True
+                    output_mupy = (er.output or b"") + b"TIMEOUT"
 
             # clean up if we had an intermediate .mpy file
             if args.via_mpy:
@@ -315,8 +494,10 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
             args, test_file_abspath, is_special
         )
 
-    # canonical form for all ports/platforms is to use \n for end-of-line
-    output_mupy = output_mupy.replace(b"\r\n", b"\n")
+    # canonical form for all ports/platforms is to use \n for end-of-line (checking for \r
+    # first is much quicker than replace() when there's nothing to replace)
+    if b"\r" in output_mupy:  # CIRCUITPY-CHANGE
+        output_mupy = output_mupy.replace(b"\r\n", b"\n")
 
     # don't try to convert the output if we should skip this test
     if had_crash or output_mupy in (b"SKIP\n", b"CRASH"):
@@ -328,17 +509,19 @@ def run_micropython(pyb, args, test_file, test_file_abspath, is_special=False):
 
     if is_special or test_file_abspath in special_tests:
         # convert parts of the output that are not stable across runs
-        with open(test_file + ".exp", "rb") as f:
-            lines_exp = []
-            for line in f.readlines():
-                if line == b"########\n":
-                    line = (line,)
-                else:
-                    line = (line, re.compile(convert_regex_escapes(line)))
-                lines_exp.append(line)
-        lines_mupy = [line + b"\n" for line in output_mupy.split(b"\n")]
-        if output_mupy.endswith(b"\n"):
-            lines_mupy = lines_mupy[:-1]  # remove erroneous last empty line
+        # CIRCUITPY-CHANGE: use the cached .exp file, and match it all at once if possible
+        exp_filename = test_file + ".exp"
+        exp_mtime = os.stat(exp_filename).st_mtime_ns
+        if output_mupy == read_exp_file(exp_filename, exp_mtime):
+            # output is exactly the expected output, so there's nothing to convert
+            return output_mupy
+        lines_exp, exp_whole = load_exp_patterns(exp_filename, exp_mtime)
+        if not output_mupy.endswith(b"\n"):
+            output_mupy += b"\n"
+        if exp_whole is not None and match_exp_whole(exp_whole, output_mupy):
+            # the output matches, so it converts to exactly the contents of the .exp file
+            return b"".join(line[0] for line in lines_exp)
+        lines_mupy = re.findall(rb"[^\n]*\n", output_mupy)
         i_mupy = 0
         for i in range(len(lines_exp)):
             if lines_exp[i][0] == b"########\n":
@@ -378,24 +561,182 @@ def run_feature_check(pyb, args, test_file):
     return run_micropython(pyb, args, test_file_path, test_file_path, is_special=True)
 
 
-class ThreadSafeCounter:
-    def __init__(self, start=0):
-        self._value = start
-        self._lock = threading.Lock()
+# CIRCUITPY-CHANGE: code to run one feature check in a batch, exec'd so a check that fails to
+# compile doesn't stop the rest.  The header fails the batch on targets without exec().
+feature_check_batch_header = "exec\n"
+feature_check_batch_code = """\
+print({marker!r})
+try:
+  exec({script!r}, {{}})
+except Exception:
+  print('CRASH')
+"""
 
-    def increment(self):
-        self.add(1)
 
-    def add(self, to_add):
-        with self._lock:
-            self._value += to_add
+# CIRCUITPY-CHANGE
+def run_feature_checks_batch(pyb, args, test_files):
+    # Run all the (non-REPL) feature checks with a single MicroPython invocation, falling
+    # back to run_feature_check() for any check the batch didn't produce output for.
+    outputs = {}
+    batch = [t for t in test_files if not t.startswith("repl_")]
+    script = [feature_check_batch_header]
+    for test_file in batch:
+        with open(base_path("feature_check", test_file), "rb") as f:
+            script.append(
+                feature_check_batch_code.format(
+                    marker="===MARK:" + test_file + "===", script=str(f.read(), "utf-8")
+                )
+            )
+    script = bytes("".join(script), "utf-8")
+    if pyb is None:
+        try:
+            output = subprocess.check_output(
+                [MICROPYTHON], input=script, stderr=subprocess.STDOUT, close_fds=False
+            )
+        except subprocess.CalledProcessError:
+            output = b""
+    else:
+        # Remote targets run scripts from a file, so write the batch out to one.
+        fd, script_filename = tempfile.mkstemp(suffix=".py")
+        with os.fdopen(fd, "wb") as f:
+            f.write(script)
+        try:
+            had_crash, output = pyb.run_script_on_remote_target(
+                args, script_filename.replace("\\", "/"), True
+            )
+        finally:
+            rm_f(script_filename)
+        if had_crash:
+            output = b""
+    # canonical form for all ports/platforms is to use \n for end-of-line
+    if b"\r" in output:
+        output = output.replace(b"\r\n", b"\n")
+    for chunk in output.split(b"===MARK:")[1:]:
+        test_file, _, output = chunk.partition(b"===\n")
+        outputs[str(test_file, "utf-8")] = output
+    for test_file in test_files:
+        if test_file not in outputs:
+            outputs[test_file] = run_feature_check(pyb, args, test_file)
+    return outputs
+
+
+# CIRCUITPY-CHANGE: code for a CPython server that forks to run each test as "python3 <test>"
+# would, replying with whether it succeeded, the output size and the output.
+cpython_server_code = """\
+import sys, posix
+while True:
+  request = sys.stdin.buffer.readline()
+  if not request:
+    sys.exit()
+  cwd, path = str(request[:-1], 'utf-8').split('\\0')
+  r, w = posix.pipe()
+  pid = posix.fork()
+  if pid == 0:
+    posix.close(r)
+    null = posix.open('/dev/null', posix.O_RDONLY)
+    posix.dup2(null, 0)
+    posix.close(null)
+    posix.dup2(w, 1)
+    posix.dup2(w, 2)
+    posix.close(w)
+    break
+  posix.close(w)
+  with open(r, 'rb') as f:
+    output = f.read()
+  status = posix.waitpid(pid, 0)[1]
+  ok = posix.WIFEXITED(status) and posix.WEXITSTATUS(status) == 0
+  sys.stdout.buffer.write(b'%d %d\\n' % (ok, len(output)) + output)
+  sys.stdout.buffer.flush()
+posix.chdir(cwd)
+sys.argv[:] = [path]
+sys.path[0] = cwd
+main = type(sys)('__main__')
+main.__file__ = path
+main.__cached__ = None
+main.__builtins__ = __builtins__
+main.__loader__ = sys.modules['_frozen_importlib_external'].SourceFileLoader('__main__', path)
+sys.modules['__main__'] = main
+with open(path, 'rb') as f:
+  code = compile(f.read(), path, 'exec')
+exec(code, main.__dict__)
+"""
 
-    def append(self, arg):
-        self.add([arg])
+# CIRCUITPY-CHANGE: tests that look at the call stack see the server's own frame below
+# theirs, so tests mentioning any of these are always run with a new CPython process.
+cpython_server_stack_words = (
+    b"settrace",
+    b"setprofile",
+    b"_getframe",
+    b"f_back",
+    b"tb_frame",
+    b"inspect",
+    b"traceback",
+    b"setrecursionlimit",
+    b"RecursionError",
+)
+
+# CIRCUITPY-CHANGE: the process running cpython_server_code for this process, None if it
+# hasn't been started yet, or False if it can't be used.
+cpython_server = None
+
+
+# CIRCUITPY-CHANGE
+def run_cpython(test_file_abspath, env):
+    # Run a test with CPython, through the server on POSIX, returning its output, or None if
+    # CPython exited with an error.
+    global cpython_server
+    cwd = os.path.dirname(test_file_abspath)
+    use_server = os.name == "posix" and cpython_server is not False
+    if use_server:
+        with open(test_file_abspath, "rb") as f:
+            source = f.read()
+        use_server = not any(word in source for word in cpython_server_stack_words)
+    if use_server:
+        try:
+            if cpython_server is None:
+                cpython_server = subprocess.Popen(
+                    CPYTHON3_CMD + ["-c", cpython_server_code],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    env=env,
+                    close_fds=False,
+                )
+            cpython_server.stdin.write(bytes(cwd + "\0" + test_file_abspath + "\n", "utf-8"))
+            cpython_server.stdin.flush()
+            ok, size = cpython_server.stdout.readline().split()
+            output = cpython_server.stdout.read(int(size))
+            if len(output) == int(size):
+                return output if int(ok) else None
+        except (OSError, ValueError):
+            pass
+        stop_cpython_server(kill=True)
+        cpython_server = False
 
-    @property
-    def value(self):
-        return self._value
+    try:
+        return subprocess.check_output(
+            CPYTHON3_CMD + [test_file_abspath],
+            cwd=cwd,
+            stderr=subprocess.STDOUT,
+            env=env,
+            close_fds=False,
+        )
+    except subprocess.CalledProcessError:
+        return None
+
+
+# CIRCUITPY-CHANGE
+def stop_cpython_server(kill=False):
+    # Stop the CPython server process, if it's running.  Closing its stdin tells it to exit
+    # once it has finished any request, or it can be killed if it isn't working.
+    if cpython_server:
+        if kill:
+            cpython_server.kill()
+        try:
+            cpython_server.stdin.close()
+        except OSError:
+            pass
+        cpython_server.stdout.close()
+        cpython_server.wait()
 
 
 class PyboardNodeRunner:
@@ -429,8 +770,9 @@ class PyboardNodeRunner:
         # Run the script.
         try:
             had_crash = False
+            # CIRCUITPY-CHANGE: close_fds=False
             output_mupy = subprocess.check_output(
-                cmdlist, stderr=subprocess.STDOUT, timeout=TEST_TIMEOUT, cwd=cwd
+                cmdlist, stderr=subprocess.STDOUT, timeout=TEST_TIMEOUT, cwd=cwd, close_fds=False
             )
         except subprocess.CalledProcessError as er:
             had_crash = True
@@ -443,12 +785,174 @@ class PyboardNodeRunner:
         return had_crash, output_mupy
 
 
-def run_tests(pyb, tests, args, result_dir, num_threads=1):
-    test_count = ThreadSafeCounter()
-    testcase_count = ThreadSafeCounter()
-    passed_count = ThreadSafeCounter()
-    failed_tests = ThreadSafeCounter([])
-    skipped_tests = ThreadSafeCounter([])
+# CIRCUITPY-CHANGE: moved to module level for make_test_spec()
+# These tests don't test slice explicitly but rather use it to perform the test
+misc_slice_tests = (
+    "builtin_range",
+    "bytearray1",
+    "class_super",
+    "containment",
+    "errno1",
+    "fun_str",
+    "generator1",
+    "globals_del",
+    "memoryview1",
+    "memoryview_gc",
+    "object1",
+    "python34",
+    "string_format_modulo",
+    "struct_endian",
+)
+
+
+# CIRCUITPY-CHANGE: the state that run_one_test() uses, set up by init_test_worker() in each
+# process that runs tests.
+test_worker_state = {}
+
+
+def init_test_worker(state):
+    test_worker_state.update(state)
+
+
+# CIRCUITPY-CHANGE: bits for the kinds of feature a test is a test of, going by its name.
+# Tests of features the target doesn't have are skipped.
+FEATURE_NATIVE = 1 << 0
+FEATURE_ENDIAN = 1 << 1
+FEATURE_INT_BIG = 1 << 2
+FEATURE_BYTEARRAY = 1 << 3
+FEATURE_SET_TYPE = 1 << 4
+FEATURE_SLICE = 1 << 5
+FEATURE_ASYNC = 1 << 6
+FEATURE_CONST = 1 << 7
+FEATURE_REVOPS = 1 << 8
+FEATURE_IO_MODULE = 1 << 9
+FEATURE_FSTRING = 1 << 10
+
+# CIRCUITPY-CHANGE: everything about a test that's worked out once from its path, with the
+# FEATURE_* bits for what it's a test of.
+TestSpec = collections.namedtuple("TestSpec", ("file", "abspath", "basename", "name", "features"))
+
+
+# CIRCUITPY-CHANGE
+def make_test_spec(args, test_file):
+    test_file = test_file.replace("\\", "/")
+    test_name = os.path.splitext(os.path.basename(test_file))[0]
+    features = 0
+    if test_name.startswith(("native_", "viper_")) or args.emit == "native":
+        features |= FEATURE_NATIVE
+    if test_name.endswith("_endian"):
+        features |= FEATURE_ENDIAN
+    if test_name.startswith("int_big") or test_name.endswith("_intbig"):
+        features |= FEATURE_INT_BIG
+    if test_name.startswith("bytearray") or test_name.endswith("_bytearray"):
+        features |= FEATURE_BYTEARRAY
+    if test_name.startswith(("set_", "frozenset")) or test_name.endswith("_set"):
+        features |= FEATURE_SET_TYPE
+    if test_name.find("slice") != -1 or test_name in misc_slice_tests:
+        features |= FEATURE_SLICE
+    if test_name.startswith(("async_", "asyncio_")):
+        features |= FEATURE_ASYNC
+    if test_name.startswith("const"):
+        features |= FEATURE_CONST
+    if "reverse_op" in test_name:
+        features |= FEATURE_REVOPS
+    if test_name.startswith("io_"):
+        features |= FEATURE_IO_MODULE
+    if test_name.startswith("string_fstring"):
+        features |= FEATURE_FSTRING
+    return TestSpec(
+        file=test_file,
+        abspath=os.path.abspath(test_file).replace("\\", "/"),
+        basename=test_file.replace("..", "_").replace("./", "").replace("/", "_"),
+        name=test_name,
+        features=features,
+    )
+
+
+# CIRCUITPY-CHANGE: module level rather than nested in run_tests(), to run in a process pool
+def run_one_test(spec):
+    # Run a single test, returning (result, spec, number of testcases, expected output,
+    # actual output), where the outputs are only given for a failed test.
+    state = test_worker_state
+    pyb = state["pyb"]
+    args = state["args"]
+
+    test_file = spec.file
+    test_file_abspath = spec.abspath
+
+    if spec.features & state["skip_features"] or test_file in state["skip_tests"]:
+        return "skip", spec, 0, None, None
+
+    # get expected output
+    test_file_expected = test_file + ".exp"
+    if state["exp_files"] is None:
+        have_exp_file = os.path.isfile(test_file_expected)
+    else:
+        have_exp_file = test_file_expected in state["exp_files"]
+    if have_exp_file:
+        # expected output given by a file, so read that in
+        if test_file_abspath in special_tests or test_file_abspath.startswith(special_test_dirs):
+            # special tests read the .exp file again to convert their output
+            output_expected = read_exp_file(
+                test_file_expected, os.stat(test_file_expected).st_mtime_ns
+            )
+        else:
+            with open(test_file_expected, "rb") as f:
+                output_expected = f.read()
+    else:
+        e = state["cpython_env"]
+
+        # use the expected output from a previous run if nothing it depends on has changed
+        output_expected = None
+        cache_filename = None
+        if not args.no_cache:
+            try:
+                cache_filename = os.path.join(
+                    EXP_CACHE_DIR,
+                    exp_cache_key(test_file_abspath, e, state["dir_states"]) + ".exp",
+                )
+                with open(cache_filename, "rb") as f:
+                    output_expected = f.read()
+            except OSError:
+                pass
+
+        if output_expected is None:
+            # run CPython to work out expected output
+            # CIRCUITPY-CHANGE: pass environment
+            output_expected = run_cpython(test_file_abspath, e)
+            if output_expected is None:
+                output_expected = b"CPYTHON3 CRASH"
+            elif cache_filename is not None:
+                write_cache_file(cache_filename, output_expected)
+
+    # canonical form for all host platforms is to use \n for end-of-line
+    if b"\r" in output_expected:
+        output_expected = output_expected.replace(b"\r\n", b"\n")
+
+    # run MicroPython
+    output_mupy = run_micropython(pyb, args, test_file, test_file_abspath)
+
+    if output_mupy == b"SKIP\n":
+        if pyb is not None and hasattr(pyb, "read_until"):
+            # Running on a target over a serial connection, and the target requested
+            # to skip the test.  It does this via a SystemExit which triggers a soft
+            # reset.  Wait for the soft reset to finish, so we don't interrupt the
+            # start-up code (eg boot.py) when preparing to run the next test.
+            pyb.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
+        return "skip", spec, 0, None, None
+
+    num_testcases = len(output_expected.splitlines())
+
+    if output_expected == output_mupy:
+        return "pass", spec, num_testcases, None, None
+    else:
+        return "fail", spec, num_testcases, output_expected, output_mupy
+
+
+def run_tests(pyb, tests, args, result_dir, num_threads=1, exp_files=None):
+    # CIRCUITPY-CHANGE: (result, spec, number of testcases) for each test run, only added to
+    # from this process and summarised once all tests are done
+    results = []
 
     skip_tests = set()
     skip_native = False
@@ -471,60 +975,74 @@ def run_tests(pyb, tests, args, result_dir, num_threads=1):
         # Even if we run completely different tests in a different directory,
         # we need to access feature_checks from the same directory as the
         # run-tests.py script itself so use base_path.
+        # CIRCUITPY-CHANGE: run the feature checks in one batch, used by the checks below
+        feature_checks = run_feature_checks_batch(
+            pyb,
+            args,
+            (
+                "native_check.py",
+                "int_big.py",
+                "bytearray.py",
+                "set_check.py",
+                "slice.py",
+                "async_check.py",
+                "const.py",
+                "reverse_ops.py",
+                "io_module.py",
+                "fstring.py",
+                "inlineasm_thumb2.py",
+                "repl_emacs_check.py",
+                "repl_words_move_check.py",
+                "byteorder.py",
+                "float.py",
+                "complex.py",
+                "coverage.py",
+            ),
+        )
 
         # Check if micropython.native is supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "native_check.py")
-        if output != b"native\n":
+        if feature_checks["native_check.py"] != b"native\n":  # CIRCUITPY-CHANGE
             skip_native = True
 
         # Check if arbitrary-precision integers are supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "int_big.py")
+        output = feature_checks["int_big.py"]  # CIRCUITPY-CHANGE
         if output != b"1000000000000000000000000000000000000000000000\n":
             skip_int_big = True
 
         # Check if bytearray is supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "bytearray.py")
-        if output != b"bytearray\n":
+        if feature_checks["bytearray.py"] != b"bytearray\n":  # CIRCUITPY-CHANGE
             skip_bytearray = True
 
         # Check if set type (and set literals) is supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "set_check.py")
-        if output != b"{1}\n":
+        if feature_checks["set_check.py"] != b"{1}\n":  # CIRCUITPY-CHANGE
             skip_set_type = True
 
         # Check if slice is supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "slice.py")
-        if output != b"slice\n":
+        if feature_checks["slice.py"] != b"slice\n":  # CIRCUITPY-CHANGE
             skip_slice = True
 
         # Check if async/await keywords are supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "async_check.py")
-        if output != b"async\n":
+        if feature_checks["async_check.py"] != b"async\n":  # CIRCUITPY-CHANGE
             skip_async = True
 
         # Check if const keyword (MicroPython extension) is supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "const.py")
-        if output != b"1\n":
+        if feature_checks["const.py"] != b"1\n":  # CIRCUITPY-CHANGE
             skip_const = True
 
         # Check if __rOP__ special methods are supported, and skip such tests if it's not
-        output = run_feature_check(pyb, args, "reverse_ops.py")
-        if output == b"TypeError\n":
+        if feature_checks["reverse_ops.py"] == b"TypeError\n":  # CIRCUITPY-CHANGE
             skip_revops = True
 
         # Check if io module exists, and skip such tests if it doesn't
-        output = run_feature_check(pyb, args, "io_module.py")
-        if output != b"io\n":
+        if feature_checks["io_module.py"] != b"io\n":  # CIRCUITPY-CHANGE
             skip_io_module = True
 
         # Check if fstring feature is enabled, and skip such tests if it doesn't
-        output = run_feature_check(pyb, args, "fstring.py")
-        if output != b"a=1\n":
+        if feature_checks["fstring.py"] != b"a=1\n":  # CIRCUITPY-CHANGE
             skip_fstring = True
 
         # Check if @micropython.asm_thumb supports Thumb2 instructions, and skip such tests if it doesn't
-        output = run_feature_check(pyb, args, "inlineasm_thumb2.py")
-        if output != b"thumb2\n":
+        if feature_checks["inlineasm_thumb2.py"] != b"thumb2\n":  # CIRCUITPY-CHANGE
             skip_tests.add("inlineasm/asmbcc.py")
             skip_tests.add("inlineasm/asmbitops.py")
             skip_tests.add("inlineasm/asmconst.py")
@@ -538,46 +1056,27 @@ def run_tests(pyb, tests, args, result_dir, num_threads=1):
             skip_tests.add("inlineasm/asmspecialregs.py")
 
         # Check if emacs repl is supported, and skip such tests if it's not
-        t = run_feature_check(pyb, args, "repl_emacs_check.py")
+        t = feature_checks["repl_emacs_check.py"]  # CIRCUITPY-CHANGE
         if "True" not in str(t, "ascii"):
             skip_tests.add("cmdline/repl_emacs_keys.py")
 
         # Check if words movement in repl is supported, and skip such tests if it's not
-        t = run_feature_check(pyb, args, "repl_words_move_check.py")
+        t = feature_checks["repl_words_move_check.py"]  # CIRCUITPY-CHANGE
         if "True" not in str(t, "ascii"):
             skip_tests.add("cmdline/repl_words_move.py")
 
-        upy_byteorder = run_feature_check(pyb, args, "byteorder.py")
-        upy_float_precision = run_feature_check(pyb, args, "float.py")
+        upy_byteorder = feature_checks["byteorder.py"]  # CIRCUITPY-CHANGE
+        upy_float_precision = feature_checks["float.py"]  # CIRCUITPY-CHANGE
         try:
             upy_float_precision = int(upy_float_precision)
         except ValueError:
             upy_float_precision = 0
-        has_complex = run_feature_check(pyb, args, "complex.py") == b"complex\n"
-        has_coverage = run_feature_check(pyb, args, "coverage.py") == b"coverage\n"
-        cpy_byteorder = subprocess.check_output(
-            CPYTHON3_CMD + [base_path("feature_check/byteorder.py")]
-        )
+        has_complex = feature_checks["complex.py"] == b"complex\n"  # CIRCUITPY-CHANGE
+        has_coverage = feature_checks["coverage.py"] == b"coverage\n"  # CIRCUITPY-CHANGE
+        # CIRCUITPY-CHANGE: the host CPython has the same byteorder as this process
+        cpy_byteorder = bytes(sys.byteorder + "\n", "ascii")
         skip_endian = upy_byteorder != cpy_byteorder
 
-    # These tests don't test slice explicitly but rather use it to perform the test
-    misc_slice_tests = (
-        "builtin_range",
-        "bytearray1",
-        "class_super",
-        "containment",
-        "errno1",
-        "fun_str",
-        "generator1",
-        "globals_del",
-        "memoryview1",
-        "memoryview_gc",
-        "object1",
-        "python34",
-        "string_format_modulo",
-        "struct_endian",
-    )
-
     # Some tests shouldn't be run on GitHub Actions
     if os.getenv("GITHUB_ACTIONS") == "true":
         skip_tests.add("thread/stress_schedule.py")  # has reliability issues
@@ -771,141 +1270,132 @@ def run_tests(pyb, tests, args, result_dir, num_threads=1):
         skip_tests.add("micropython/schedule.py")  # native code doesn't check pending events
         skip_tests.add("stress/bytecode_limit.py")  # bytecode specific test
 
-    def run_one_test(test_file):
-        test_file = test_file.replace("\\", "/")
-        test_file_abspath = os.path.abspath(test_file).replace("\\", "/")
-
-        if args.filters:
-            # Default verdict is the opposit of the first action
-            verdict = "include" if args.filters[0][0] == "exclude" else "exclude"
-            for action, pat in args.filters:
-                if pat.search(test_file):
-                    verdict = action
-            if verdict == "exclude":
-                return
-
-        test_basename = test_file.replace("..", "_").replace("./", "").replace("/", "_")
-        test_name = os.path.splitext(os.path.basename(test_file))[0]
-        is_native = (
-            test_name.startswith("native_")
-            or test_name.startswith("viper_")
-            or args.emit == "native"
-        )
-        is_endian = test_name.endswith("_endian")
-        is_int_big = test_name.startswith("int_big") or test_name.endswith("_intbig")
-        is_bytearray = test_name.startswith("bytearray") or test_name.endswith("_bytearray")
-        is_set_type = test_name.startswith(("set_", "frozenset")) or test_name.endswith("_set")
-        is_slice = test_name.find("slice") != -1 or test_name in misc_slice_tests
-        is_async = test_name.startswith(("async_", "asyncio_"))
-        is_const = test_name.startswith("const")
-        is_io_module = test_name.startswith("io_")
-        is_fstring = test_name.startswith("string_fstring")
-
-        skip_it = test_file in skip_tests
-        skip_it |= skip_native and is_native
-        skip_it |= skip_endian and is_endian
-        skip_it |= skip_int_big and is_int_big
-        skip_it |= skip_bytearray and is_bytearray
-        skip_it |= skip_set_type and is_set_type
-        skip_it |= skip_slice and is_slice
-        skip_it |= skip_async and is_async
-        skip_it |= skip_const and is_const
-        skip_it |= skip_revops and "reverse_op" in test_name
-        skip_it |= skip_io_module and is_io_module
-        skip_it |= skip_fstring and is_fstring
-
-        if skip_it:
-            print("skip ", test_file)
-            skipped_tests.append(test_name)
+    # CIRCUITPY-CHANGE: work out each test's TestSpec, and apply the filters, up front
+    specs = [make_test_spec(args, test_file) for test_file in tests]
+
+    if args.filters:
+        # Default verdict is the opposite of the first action, and the last matching filter
+        # wins, so check the filters from last to first and stop at the first match.
+        default_include = args.filters[0][0] == "exclude"
+        filters = tuple((action == "include", pat) for action, pat in reversed(args.filters))
+
+        def is_included(spec):
+            for include, pat in filters:
+                if pat.search(spec.file):
+                    return include
+            return default_include
+
+        specs = [spec for spec in specs if is_included(spec)]
+
+    # CIRCUITPY-CHANGE: print and save the result of a test, in this process
+    def record_result(result):
+        status, spec, num_testcases, output_expected, output_mupy = result
+        results.append((status, spec, num_testcases))
+        if status == "skip":
+            print("skip ", spec.file)
             return
 
-        # get expected output
-        test_file_expected = test_file + ".exp"
-        if os.path.isfile(test_file_expected):
-            # expected output given by a file, so read that in
-            with open(test_file_expected, "rb") as f:
-                output_expected = f.read()
-        else:
-            # CIRCUITPY-CHANGE: set language & make sure testlib is available for `skip_ok`.
-            e = {
-                "PYTHONPATH": base_path("testlib"),
-                "PATH": os.environ["PATH"],
-                "LANG": "en_US.UTF-8",
-            }
-            # CIRCUITPY-CHANGE: --keep-path applies to PYTHONPATH as well
-            if args.keep_path and os.getenv("PYTHONPATH"):
-                e["PYTHONPATH"] += ":" + os.getenv("PYTHONPATH")
+        filename_expected = os.path.join(result_dir, spec.basename + ".exp")
+        filename_mupy = os.path.join(result_dir, spec.basename + ".out")
 
-            # run CPython to work out expected output
-            try:
-                output_expected = subprocess.check_output(
-                    CPYTHON3_CMD + [test_file_abspath],
-                    cwd=os.path.dirname(test_file),
-                    stderr=subprocess.STDOUT,
-                    # CIRCUITPY-CHANGE: pass environment
-                    env=e,
-                )
-            except subprocess.CalledProcessError:
-                output_expected = b"CPYTHON3 CRASH"
-
-        # canonical form for all host platforms is to use \n for end-of-line
-        output_expected = output_expected.replace(b"\r\n", b"\n")
-
-        # run MicroPython
-        output_mupy = run_micropython(pyb, args, test_file, test_file_abspath)
-
-        if output_mupy == b"SKIP\n":
-            if pyb is not None and hasattr(pyb, "read_until"):
-                # Running on a target over a serial connection, and the target requested
-                # to skip the test.  It does this via a SystemExit which triggers a soft
-                # reset.  Wait for the soft reset to finish, so we don't interrupt the
-                # start-up code (eg boot.py) when preparing to run the next test.
-                pyb.read_until(1, b"raw REPL; CTRL-B to exit\r\n")
-            print("skip ", test_file)
-            skipped_tests.append(test_name)
-            return
-
-        testcase_count.add(len(output_expected.splitlines()))
-
-        filename_expected = os.path.join(result_dir, test_basename + ".exp")
-        filename_mupy = os.path.join(result_dir, test_basename + ".out")
-
-        if output_expected == output_mupy:
-            print("pass ", test_file)
-            passed_count.increment()
+        if status == "pass":
+            print("pass ", spec.file)
             rm_f(filename_expected)
             rm_f(filename_mupy)
         else:
+            print("FAIL ", spec.file)
             with open(filename_expected, "wb") as f:
                 f.write(output_expected)
             with open(filename_mupy, "wb") as f:
                 f.write(output_mupy)
-            print("FAIL ", test_file)
-            failed_tests.append((test_name, test_file))
 
-        test_count.increment()
+    # CIRCUITPY-CHANGE: environment for running CPython for expected output, set up once.
+    # CIRCUITPY-CHANGE: set language & make sure testlib is available for `skip_ok`.
+    cpython_env = {
+        "PYTHONPATH": TESTLIB_DIR,
+        "PATH": os.environ["PATH"],
+        "LANG": "en_US.UTF-8",
+    }
+    # CIRCUITPY-CHANGE: --keep-path applies to PYTHONPATH as well
+    if args.keep_path and os.getenv("PYTHONPATH"):
+        cpython_env["PYTHONPATH"] += ":" + os.getenv("PYTHONPATH")
+
+    # CIRCUITPY-CHANGE: FEATURE_* bits for the features the target doesn't have
+    skip_features = 0
+    for skip, feature in (
+        (skip_native, FEATURE_NATIVE),
+        (skip_endian, FEATURE_ENDIAN),
+        (skip_int_big, FEATURE_INT_BIG),
+        (skip_bytearray, FEATURE_BYTEARRAY),
+        (skip_set_type, FEATURE_SET_TYPE),
+        (skip_slice, FEATURE_SLICE),
+        (skip_async, FEATURE_ASYNC),
+        (skip_const, FEATURE_CONST),
+        (skip_revops, FEATURE_REVOPS),
+        (skip_io_module, FEATURE_IO_MODULE),
+        (skip_fstring, FEATURE_FSTRING),
+    ):
+        if skip:
+            skip_features |= feature
+
+    # CIRCUITPY-CHANGE: state of the directories that cached expected output depends on, taken
+    # once before any test runs, so files tests create while running don't change the keys.
+    dir_states = {}
+    if not args.no_cache:
+        for dir in {os.path.dirname(spec.abspath) for spec in specs} | {TESTLIB_DIR}:
+            dir_states[dir] = dir_tree_state(dir)
+
+    state = {  # CIRCUITPY-CHANGE
+        "pyb": pyb,
+        "args": args,
+        "skip_tests": frozenset(skip_tests),
+        "exp_files": exp_files,
+        "cpython_env": cpython_env,
+        "dir_states": dir_states,
+        "skip_features": skip_features,
+    }
 
     if pyb:
         num_threads = 1
 
     if num_threads > 1:
-        pool = ThreadPool(num_threads)
-        pool.map(run_one_test, tests)
+        # CIRCUITPY-CHANGE: use processes rather than threads, so tests aren't serialised by
+        # the GIL, and hand them out one at a time so a slow test doesn't hold up others.
+        with multiprocessing.Pool(num_threads, init_test_worker, (state,)) as pool:
+            for result in pool.imap_unordered(run_one_test, specs, 1):
+                record_result(result)
     else:
-        for test in tests:
-            run_one_test(test)
+        init_test_worker(state)
+        try:
+            for spec in specs:
+                record_result(run_one_test(spec))
+        finally:
+            stop_cpython_server()
+
+    # CIRCUITPY-CHANGE: summarise the results once all tests are done
+    test_count = 0
+    testcase_count = 0
+    passed_count = 0
+    failed_tests = []
+    skipped_tests = []
+    for status, spec, num_testcases in results:
+        if status == "skip":
+            skipped_tests.append(spec.name)
+            continue
+        test_count += 1
+        testcase_count += num_testcases
+        if status == "pass":
+            passed_count += 1
+        else:
+            failed_tests.append((spec.name, spec.file))
 
-    print(
-        "{} tests performed ({} individual testcases)".format(
-            test_count.value, testcase_count.value
-        )
-    )
-    print("{} tests passed".format(passed_count.value))
+    print("{} tests performed ({} individual testcases)".format(test_count, testcase_count))
+    print("{} tests passed".format(passed_count))
 
-    skipped_tests = sorted(skipped_tests.value)
+    skipped_tests.sort()
     if len(skipped_tests) > 0:
         print("{} tests skipped: {}".format(len(skipped_tests), " ".join(skipped_tests)))
-    failed_tests = sorted(failed_tests.value)
+    failed_tests.sort()
 
     # Serialize regex added by append_filter.
     def to_json(obj):
@@ -913,12 +1403,13 @@ def run_tests(pyb, tests, args, result_dir, num_threads=1):
             return obj.pattern
         return obj
 
+    # CIRCUITPY-CHANGE: serialize first, so the results file is written with a single write.
+    results_json = json.dumps(
+        {"args": vars(args), "failed_tests": [test[1] for test in failed_tests]},
+        default=to_json,
+    )
     with open(os.path.join(result_dir, RESULTS_FILE), "w") as f:
-        json.dump(
-            {"args": vars(args), "failed_tests": [test[1] for test in failed_tests]},
-            f,
-            default=to_json,
-        )
+        f.write(results_json)
 
     if len(failed_tests) > 0:
         print(
@@ -947,6 +1438,7 @@ class append_filter(argparse.Action):
 
 
 def main():
+    # CIRCUITPY-CHANGE: the description also covers the cache
     cmd_parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="""Run and manage tests for MicroPython.
@@ -960,6 +1452,10 @@ produced by running the test through CPython unless a <test>.exp file is found,
 case it is used as comparison.
 If a test fails, run-tests.py produces a pair of <test>.out and <test>.exp files in the result
 directory with the MicroPython output and the expectations, respectively.
+Expected output produced by CPython, and .mpy files compiled by mpy-cross for --via-mpy, are
+cached between runs, and shared by all checkouts, in $XDG_CACHE_HOME/micropython-tests
+(~/.cache/micropython-tests by default).  Entries are never removed: delete that directory to
+clear the cache, or use --no-cache to not use it at all.
 """,
         epilog="""\
 Options -i and -e can be multiple and processed in the order given. Regex
@@ -1014,6 +1510,12 @@ the last matching regex is used:
     cmd_parser.add_argument(
         "--keep-path", action="store_true", help="do not clear MICROPYPATH when running tests"
     )
+    # CIRCUITPY-CHANGE
+    cmd_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't use or update the cache in " + CACHE_DIR,
+    )
     cmd_parser.add_argument(
         "-j",
         "--jobs",
@@ -1101,6 +1603,9 @@ the last matching regex is used:
             "--run-failures cannot be used together with files or --test-dirs arguments"
         )
 
+    # CIRCUITPY-CHANGE: set of .exp files in the test directories, when they're searched.
+    exp_files = None
+
     if args.run_failures:
         results_file = os.path.join(args.result_dir, RESULTS_FILE)
         if os.path.exists(results_file):
@@ -1157,13 +1662,29 @@ the last matching regex is used:
         else:
             # run tests from these directories
             test_dirs = args.test_dirs
-        tests = sorted(
-            test_file
-            for test_files in (
-                glob(os.path.join(dir, ext)) for dir in test_dirs for ext in test_extensions
-            )
-            for test_file in test_files
-        )
+        # CIRCUITPY-CHANGE: list each test directory (which may be a glob pattern) once, to
+        # find both the tests and their .exp files.
+        tests = []
+        exp_files = set()
+        for dir_pattern in test_dirs:
+            if glob_escape(dir_pattern) == dir_pattern:
+                dirs = (dir_pattern,)
+            else:
+                dirs = glob(dir_pattern)
+            for dir in dirs:
+                if not os.path.isdir(dir):
+                    continue
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        name = entry.name
+                        if name.startswith("."):
+                            # hidden files aren't matched by glob
+                            continue
+                        if name.endswith(".exp"):
+                            exp_files.add(os.path.join(dir, name).replace("\\", "/"))
+                        elif any(fnmatch(name, ext) for ext in test_extensions):
+                            tests.append(os.path.join(dir, name))
+        tests.sort()
     else:
         # tests explicitly given
         tests = args.files
@@ -1174,7 +1695,7 @@ the last matching regex is used:
         os.environ["MICROPYPATH"] = os.pathsep.join(
             [
                 ".frozen",
-                base_path("testlib"),
+                TESTLIB_DIR,  # CIRCUITPY-CHANGE
                 base_path("../frozen/Adafruit_CircuitPython_asyncio"),
                 base_path("../frozen/Adafruit_CircuitPython_Ticks"),
             ]
@@ -1182,7 +1703,9 @@ the last matching regex is used:
 
     try:
         os.makedirs(args.result_dir, exist_ok=True)
-        res = run_tests(pyb, tests, args, args.result_dir, args.jobs)
+        res = run_tests(
+            pyb, tests, args, args.result_dir, args.jobs, exp_files
+        )  # CIRCUITPY-CHANGE
     finally:
         if pyb:
             pyb.close()